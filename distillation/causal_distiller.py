@@ -309,7 +309,7 @@ class CausalDistiller:
         attn_mask = torch.arange(token_ids.size(1), dtype=torch.long, device=lengths.device) < lengths[:, None]
 
         bs, max_seq_len = token_ids.size()
-        mlm_labels = token_ids.new(token_ids.size()).copy_(token_ids)
+        mlm_labels = token_ids.clone()
 
         x_prob = self.token_probs[token_ids.flatten()]
         n_tgt = math.ceil(self.mlm_mask_prop * lengths.sum().item())
@@ -335,7 +335,7 @@ class CausalDistiller:
 
         _token_ids_real = token_ids[pred_mask]
         _token_ids_rand = _token_ids_real.clone().random_(self.vocab_size)
-        _token_ids_mask = _token_ids_real.clone().fill_(self.params.special_tok_ids["mask_token"])
+        _token_ids_mask = torch.full_like(_token_ids_real, self.params.special_tok_ids["mask_token"])
         probs = torch.multinomial(self.pred_probs, len(_token_ids_real), replacement=True).to(_token_ids_real.device, non_blocking=True)
         _token_ids = (
             _token_ids_mask * (probs == 0).long()
@@ -372,7 +372,7 @@ class CausalDistiller:
         assert token_ids.size(0) == lengths.size(0)
 
         attn_mask = torch.arange(token_ids.size(1), dtype=torch.long, device=lengths.device) < lengths[:, None]
-        clm_labels = token_ids.new(token_ids.size()).copy_(token_ids)
+        clm_labels = token_ids.clone()
         clm_labels[~attn_mask] = -100  # previously `clm_labels[1-attn_mask] = -1`, cf pytorch 1.2.0 compatibility
 
         # sanity checks
@@ -419,7 +419,7 @@ class CausalDistiller:
                 pad_id = self.params.special_tok_ids["pad_token"]
             else:
                 pad_id = self.params.special_tok_ids["unk_token"]
-            padding_tensor = torch.zeros(bs2, pad, dtype=torch.long, device=x.device).fill_(pad_id)
+            padding_tensor = torch.full((bs2, pad), pad_id, dtype=torch.long, device=x.device)
             x = torch.cat([x, padding_tensor], 1)
             assert x.size() == (bs2, ml2)
 
@@ -701,6 +701,13 @@ class CausalDistiller:
         else:
             counterfactual_input_ids = input_ids
         
+        # flat indices of the labelled tokens, shared by the regular and the causal student forwards. They index the
+        # whole batch, so they cannot be handed to nn.DataParallel, which would split them across replicas: there
+        # each replica rebuilds them from its own slice of `lm_labels` instead.
+        kept_token_idx = None
+        if self.params.restrict_ce_to_mask and not isinstance(self.student, nn.DataParallel):
+            kept_token_idx = (lm_labels.view(-1) > -1).nonzero(as_tuple=True)[0]  # (n_kept,)
+
         if self.mlm:
             with torch.no_grad():
                 # teacher forward pass normal.
@@ -735,20 +742,25 @@ class CausalDistiller:
                 temperature=self.temperature,
                 restrict_ce_to_mask=self.params.restrict_ce_to_mask,
                 lm_labels=lm_labels,
+                kept_token_idx=kept_token_idx,
+                alpha_ce=self.alpha_ce,
                 alpha_mlm=self.alpha_mlm,
                 alpha_clm=self.alpha_clm,
                 alpha_mse=self.alpha_mse,
                 alpha_cos=self.alpha_cos,
             )  # (bs, seq_length, voc_size)
-            s_logits, s_hidden_states = student_outputs["logits"], student_outputs["hidden_states"]
+            # hidden states are only returned when the cosine loss needs them.
+            s_logits, s_hidden_states = student_outputs["logits"], student_outputs.hidden_states
             causal_t_logits, causal_t_hidden_states = \
                 counterfactual_outputs_teacher["logits"], counterfactual_outputs_teacher["hidden_states"]
         else:
             assert False # we are not supporting this branch!
         
         # standard losses.
-        loss_ce = student_outputs["loss_ce"].mean() if self.multi_gpu else student_outputs["loss_ce"]
-        loss = self.alpha_ce * loss_ce
+        loss = 0.0
+        if self.alpha_ce > 0.0:
+            loss_ce = student_outputs["loss_ce"].mean() if self.multi_gpu else student_outputs["loss_ce"]
+            loss += self.alpha_ce * loss_ce
 
         if self.alpha_mlm > 0.0:
             loss_mlm = student_outputs["loss_mlm"].mean() if self.multi_gpu else student_outputs["loss_mlm"]
@@ -768,7 +780,8 @@ class CausalDistiller:
             self.student,
             dual_input_ids, # this is different!
             dual_attention_mask, # this is different!
-            variable_names=student_variable_names
+            variable_names=student_variable_names,
+            skip_lm_head=True,
         )
         # dual on main.
         counterfactual_outputs_student = self.student(
@@ -788,6 +801,8 @@ class CausalDistiller:
             s_hidden_states=s_hidden_states,
             temperature=self.temperature,
             restrict_ce_to_mask=self.params.restrict_ce_to_mask,
+            lm_labels=lm_labels,
+            kept_token_idx=kept_token_idx,
         )
         # sanity check.
         assert "loss_ce" not in counterfactual_outputs_student
@@ -804,7 +819,8 @@ class CausalDistiller:
                 
         self.total_loss_epoch += loss.item()
         self.last_loss = loss.item()
-        self.last_loss_ce = loss_ce.item()
+        if self.alpha_ce > 0.0:
+            self.last_loss_ce = loss_ce.item()
         if self.alpha_mlm > 0.0:
             self.last_loss_mlm = loss_mlm.item()
         if self.alpha_clm > 0.0:
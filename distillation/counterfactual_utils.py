@@ -58,14 +58,18 @@ def get_head_dimension(
     
 def get_activation_at(
     model, input_ids, attention_mask, 
-    variable_names
+    variable_names,
+    skip_lm_head=False,
 ):
     if variable_names == "embeddings":
         return None
 
+    # only the hidden states are read, models that support it can skip the vocabulary projection.
+    model_kwargs = {"skip_lm_head": True} if skip_lm_head else {}
     outputs = model(
         input_ids=input_ids, 
-        attention_mask=attention_mask
+        attention_mask=attention_mask,
+        **model_kwargs
     )
     if not isinstance(model, torch.nn.DataParallel):
         head_dimension = model.config.hidden_size // model.config.num_attention_heads
@@ -18,11 +18,10 @@
 """
 
 
+import contextlib
 import math
 
-import numpy as np
 import torch
-from packaging import version
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
@@ -53,7 +52,22 @@ from transformers import (
     DistilBertConfig,
 )
 
+try:
+    from flash_attn.ops.triton.layer_norm import layer_norm_fn
+except ImportError:
+    layer_norm_fn = None
+
+try:
+    from apex.normalization import FusedLayerNorm
+except ImportError:
+    FusedLayerNorm = None
+
 logger = logging.get_logger(__name__)
+
+# Let `scaled_dot_product_attention` dispatch to the FlashAttention kernels whenever the inputs allow it.
+if hasattr(torch.backends.cuda, "enable_flash_sdp"):
+    torch.backends.cuda.enable_flash_sdp(True)
+
 _CHECKPOINT_FOR_DOC = "distilbert-base-uncased"
 _CONFIG_FOR_DOC = "DistilBertConfig"
 _TOKENIZER_FOR_DOC = "DistilBertTokenizer"
@@ -84,13 +98,141 @@ def create_sinusoidal_embeddings(n_pos, dim, out):
 
 
 def _create_sinusoidal_embeddings(n_pos, dim, out):
-    position_enc = np.array([[pos / np.power(10000, 2 * (j // 2) / dim) for j in range(dim)] for pos in range(n_pos)])
+    # Column pair (2i, 2i + 1) encodes pos / 10000^(2i / dim), built as an outer product directly on `out`'s device.
+    position = torch.arange(n_pos, dtype=torch.float64, device=out.device).unsqueeze(1)  # (n_pos, 1)
+    inv_freq = torch.exp(
+        torch.arange(0, dim, 2, dtype=torch.float64, device=out.device) * (-math.log(10000.0) / dim)
+    )  # (ceil(dim / 2),)
+    position_enc = position * inv_freq  # (n_pos, ceil(dim / 2))
     out.requires_grad = False
-    out[:, 0::2] = torch.FloatTensor(np.sin(position_enc[:, 0::2]))
-    out[:, 1::2] = torch.FloatTensor(np.cos(position_enc[:, 1::2]))
+    with torch.no_grad():
+        out[:, 0::2] = torch.sin(position_enc)
+        out[:, 1::2] = torch.cos(position_enc[:, : dim // 2])
     out.detach_()
 
 
+def _make_layer_norm(dim, eps):
+    """Returns apex's FusedLayerNorm when apex is installed, a regular nn.LayerNorm otherwise."""
+    if FusedLayerNorm is not None:
+        return FusedLayerNorm(dim, eps=eps)
+    return nn.LayerNorm(dim, eps=eps)
+
+
+def fused_add_layer_norm(x, residual, layer_norm):
+    """
+    Computes `layer_norm(x + residual)`. With flash-attn installed, the residual add is done inside the LayerNorm
+    kernel on GPU so the sum is never written back to memory. `x` must be a fresh activation that the caller does not
+    reuse: without autograd it is overwritten with the sum instead of allocating a new tensor. That in-place path is
+    only taken when both have the same dtype, so that e.g. a bf16 `x` under autocast does not round the fp32 residual.
+    """
+    if layer_norm_fn is not None and x.is_cuda:
+        return layer_norm_fn(x, layer_norm.weight, layer_norm.bias, residual=residual, eps=layer_norm.eps)
+    if not torch.is_grad_enabled() and x.dtype == residual.dtype:
+        return layer_norm(x.add_(residual))
+    return layer_norm(x + residual)
+
+
+@torch.jit.script
+def bias_gelu(x, bias):
+    # Scripted so the bias add and the GeLU run as a single fused pointwise kernel. The bias is cast to the matmul
+    # output's dtype so a bf16 `x` under autocast is not promoted to fp32 by an fp32 bias.
+    return torch.nn.functional.gelu(x + bias.to(x.dtype))
+
+
+@torch.jit.script
+def gelu_layer_norm(x, weight, bias, eps: float):
+    # Scripted so the GeLU output is fed to the LayerNorm reduction without a separate pointwise kernel.
+    return torch.nn.functional.layer_norm(torch.nn.functional.gelu(x), weight.shape, weight, bias, eps)
+
+
+def labelled_lm_loss(loss_fct, logits, labels):
+    """
+    `loss_fct(logits.reshape(-1, voc_size), labels.reshape(-1))` computed on the labelled (non -100) positions only, so
+    the softmax runs over the rows that contribute to the loss instead of every position.
+    """
+    labels = labels.reshape(-1)  # (bs * seq_length,)
+    keep_idx = (labels != -100).nonzero(as_tuple=True)[0]  # (n_labelled,)
+    logits = logits.reshape(-1, logits.size(-1)).index_select(0, keep_idx).float()  # (n_labelled, voc_size)
+    return loss_fct(logits, labels.index_select(0, keep_idx))
+
+
+def labelled_lm_losses(logits, *labels):
+    """
+    One cross-entropy of `logits` per label tensor in `labels`, each ignoring its -100 positions. The log_softmax is
+    computed once, over the positions labelled in any of them, and shared by all the losses.
+    """
+    labels = [label.reshape(-1) for label in labels]  # (bs * seq_length,) each
+    labelled = labels[0] != -100
+    for label in labels[1:]:
+        labelled |= label != -100
+    keep_idx = labelled.nonzero(as_tuple=True)[0]  # (n_labelled,)
+    logits = logits.reshape(-1, logits.size(-1)).index_select(0, keep_idx).float()  # (n_labelled, voc_size)
+    log_probs = nn.functional.log_softmax(logits, dim=-1)
+    return [nn.functional.nll_loss(log_probs, label.index_select(0, keep_idx), ignore_index=-100) for label in labels]
+
+
+def cosine_loss(s_hidden_states, t_hidden_states):
+    """
+    Same value as `CosineEmbeddingLoss` with an all-ones target: mean(1 - cos(s, t)) over the rows. Written as a dot
+    product of normalized rows so it reduces to a couple of fusable kernels.
+    """
+    s_hidden_states = nn.functional.normalize(s_hidden_states, dim=-1)
+    t_hidden_states = nn.functional.normalize(t_hidden_states, dim=-1)
+    return (1.0 - (s_hidden_states * t_hidden_states).sum(-1)).mean()
+
+
+def distill_losses(
+    s_logits,
+    t_logits,
+    s_hidden_state,
+    t_hidden_state,
+    keep_idx,
+    token_keep_idx,
+    temperature,
+    with_ce: bool = True,
+    with_mse: bool = False,
+):
+    """
+    Distillation losses between a student and a teacher forward, shared by the regular and the causal (interchanged)
+    losses. The logits losses are computed on the `keep_idx` rows and the cosine loss on the `token_keep_idx` rows of
+    the last hidden states; the cosine loss is skipped when `s_hidden_state` is None.
+    """
+    losses = {}
+    if with_ce or with_mse:
+        vocab_size = s_logits.size(-1)
+        # https://github.com/peterliht/knowledge-distillation-pytorch/blob/master/model/net.py#L100
+        # https://github.com/peterliht/knowledge-distillation-pytorch/issues/2
+        s_logits_slct = s_logits.reshape(-1, vocab_size).index_select(0, keep_idx)  # (n_kept, voc_size)
+        t_logits_slct = t_logits.reshape(-1, vocab_size).index_select(0, keep_idx)  # (n_kept, voc_size)
+    if with_ce:
+        inv_temperature = 1.0 / temperature
+        # the per-row mean and the T^2 factor folded into a single scale of the summed loss. With no kept rows (e.g. a
+        # DataParallel replica without masked tokens) the sum is 0, and so is the loss.
+        ce_scale = temperature * temperature / max(s_logits_slct.size(0), 1)
+        # both sides go through the same log_softmax so a compiled graph can fuse the two row reductions.
+        s_log_probs = nn.functional.log_softmax(s_logits_slct * inv_temperature, dim=-1)  # (n_kept, voc_size)
+        t_log_probs = nn.functional.log_softmax(t_logits_slct * inv_temperature, dim=-1)  # (n_kept, voc_size)
+        losses["ce"] = (
+            nn.functional.kl_div(s_log_probs, t_log_probs, reduction="sum", log_target=True).float() * ce_scale
+        )
+    if with_mse:
+        # Reproducing batchmean reduction
+        losses["mse"] = nn.functional.mse_loss(s_logits_slct, t_logits_slct, reduction="sum") / s_logits_slct.size(0)
+    if s_hidden_state is not None:
+        losses["cos"] = selected_cosine_loss(s_hidden_state, t_hidden_state, token_keep_idx)
+    return losses
+
+
+def selected_cosine_loss(s_hidden_state, t_hidden_state, token_keep_idx):
+    """
+    `cosine_loss` between the `token_keep_idx` rows of two `(bs, seq_length, dim)` hidden states.
+    """
+    dim = s_hidden_state.size(-1)
+    s_hidden_state_slct = s_hidden_state.reshape(-1, dim).index_select(0, token_keep_idx)  # (n_tokens, dim)
+    t_hidden_state_slct = t_hidden_state.reshape(-1, dim).index_select(0, token_keep_idx)  # (n_tokens, dim)
+    return cosine_loss(s_hidden_state_slct, t_hidden_state_slct)
+
+
 class Embeddings(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -101,12 +243,8 @@ class Embeddings(nn.Module):
                 n_pos=config.max_position_embeddings, dim=config.dim, out=self.position_embeddings.weight
             )
 
-        self.LayerNorm = nn.LayerNorm(config.dim, eps=1e-12)
-        self.dropout = nn.Dropout(config.dropout)
-        if version.parse(torch.__version__) > version.parse("1.6.0"):
-            self.register_buffer(
-                "position_ids", torch.arange(config.max_position_embeddings).expand((1, -1)), persistent=False
-            )
+        self.LayerNorm = _make_layer_norm(config.dim, eps=1e-12)
+        self.dropout_p = config.dropout
 
     def forward(self, input_ids):
         """
@@ -118,50 +256,61 @@ class Embeddings(nn.Module):
         """
         seq_length = input_ids.size(1)
 
-        # Setting the position-ids to the registered buffer in constructor, it helps
-        # when tracing the model without passing position-ids, solves
-        # isues similar to issue #5664
-        if hasattr(self, "position_ids"):
-            position_ids = self.position_ids[:, :seq_length]
-        else:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)  # (max_seq_length)
-            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)  # (bs, max_seq_length)
-
         word_embeddings = self.word_embeddings(input_ids)  # (bs, max_seq_length, dim)
-        position_embeddings = self.position_embeddings(position_ids)  # (bs, max_seq_length, dim)
+        # Positions are always 0..seq_length-1, so slice the table instead of gathering it and let the add broadcast
+        # over the batch.
+        position_embeddings = self.position_embeddings.weight[:seq_length]  # (max_seq_length, dim)
 
         embeddings = word_embeddings + position_embeddings  # (bs, max_seq_length, dim)
         embeddings = self.LayerNorm(embeddings)  # (bs, max_seq_length, dim)
-        embeddings = self.dropout(embeddings)  # (bs, max_seq_length, dim)
+        embeddings = nn.functional.dropout(embeddings, self.dropout_p, self.training)  # (bs, max_seq_length, dim)
         return embeddings
 
 
+def _split_qkv_state_dict(module, state_dict, prefix, local_metadata):
+    # Save the fused projection as separate q/k/v linears so checkpoints stay loadable by stock DistilBERT.
+    for w in ["weight", "bias"]:
+        fused = state_dict.pop(f"{prefix}qkv_lin.{w}")
+        for name, value in zip(["q_lin", "k_lin", "v_lin"], fused.chunk(3, dim=0)):
+            state_dict[f"{prefix}{name}.{w}"] = value.clone()
+    return state_dict
+
+
 class MultiHeadSelfAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
 
         self.n_heads = config.n_heads
         self.dim = config.dim
-        self.dropout = nn.Dropout(p=config.attention_dropout)
+        self.attn_dropout_p = config.attention_dropout
 
         assert self.dim % self.n_heads == 0
 
-        self.q_lin = nn.Linear(in_features=config.dim, out_features=config.dim)
-        self.k_lin = nn.Linear(in_features=config.dim, out_features=config.dim)
-        self.v_lin = nn.Linear(in_features=config.dim, out_features=config.dim)
+        # query, key and value projections stacked row-wise in a single GEMM. Checkpoints keep the original
+        # `q_lin`/`k_lin`/`v_lin` layout, see `_split_qkv_state_dict` and `_load_from_state_dict`.
+        self.qkv_lin = nn.Linear(in_features=config.dim, out_features=3 * config.dim)
         self.out_lin = nn.Linear(in_features=config.dim, out_features=config.dim)
 
         self.pruned_heads = set()
 
+        self._register_state_dict_hook(_split_qkv_state_dict)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Port checkpoints with separate q/k/v projections by concatenating their rows.
+        for w in ["weight", "bias"]:
+            keys = [f"{prefix}{name}.{w}" for name in ["q_lin", "k_lin", "v_lin"]]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}qkv_lin.{w}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def prune_heads(self, heads):
         attention_head_size = self.dim // self.n_heads
         if len(heads) == 0:
             return
         heads, index = find_pruneable_heads_and_indices(heads, self.n_heads, attention_head_size, self.pruned_heads)
-        # Prune linear layers
-        self.q_lin = prune_linear_layer(self.q_lin, index)
-        self.k_lin = prune_linear_layer(self.k_lin, index)
-        self.v_lin = prune_linear_layer(self.v_lin, index)
+        # Prune linear layers, the fused projection holds three contiguous (dim,) blocks
+        qkv_index = torch.cat([index, index + self.dim, index + 2 * self.dim])
+        self.qkv_lin = prune_linear_layer(self.qkv_lin, qkv_index)
         self.out_lin = prune_linear_layer(self.out_lin, index, dim=1)
         # Update hyper params
         self.n_heads = self.n_heads - len(heads)
@@ -174,46 +323,60 @@ class MultiHeadSelfAttention(nn.Module):
             query: torch.tensor(bs, seq_length, dim)
             key: torch.tensor(bs, seq_length, dim)
             value: torch.tensor(bs, seq_length, dim)
-            mask: torch.tensor(bs, seq_length)
+            mask: torch.tensor(bs, 1, 1, seq_length) Additive attention mask (0 to attend, large negative to ignore)
 
         Returns:
             weights: torch.tensor(bs, n_heads, seq_length, seq_length) Attention weights context: torch.tensor(bs,
             seq_length, dim) Contextualized layer. Optional: only if `output_attentions=True`
         """
         bs, q_length, dim = query.size()
-        k_length = key.size(1)
         # assert dim == self.dim, f'Dimensions do not match: {dim} input vs {self.dim} configured'
         # assert key.size() == value.size()
 
         dim_per_head = self.dim // self.n_heads
 
-        mask_reshp = (bs, 1, 1, k_length)
-
         def shape(x):
             """separate heads"""
-            return x.view(bs, -1, self.n_heads, dim_per_head).transpose(1, 2)
+            return x.view(bs, -1, self.n_heads, dim_per_head).permute(0, 2, 1, 3)
 
         def unshape(x):
             """group heads"""
-            return x.transpose(1, 2).contiguous().view(bs, -1, self.n_heads * dim_per_head)
-
-        q = shape(self.q_lin(query))  # (bs, n_heads, q_length, dim_per_head)
-        k = shape(self.k_lin(key))  # (bs, n_heads, k_length, dim_per_head)
-        v = shape(self.v_lin(value))  # (bs, n_heads, k_length, dim_per_head)
+            # reshape only copies when the layout requires it
+            return x.transpose(1, 2).reshape(bs, -1, self.n_heads * dim_per_head)
 
-        q = q / math.sqrt(dim_per_head)  # (bs, n_heads, q_length, dim_per_head)
-        scores = torch.matmul(q, k.transpose(2, 3))  # (bs, n_heads, q_length, k_length)
-        mask = (mask == 0).view(mask_reshp).expand_as(scores)  # (bs, n_heads, q_length, k_length)
-        scores.masked_fill_(mask, -float("inf"))  # (bs, n_heads, q_length, k_length)
+        if query is key and key is value:
+            q, k, v = self.qkv_lin(query).chunk(3, dim=-1)  # 3 x (bs, seq_length, dim)
+        else:
+            q_weight, k_weight, v_weight = self.qkv_lin.weight.chunk(3, dim=0)
+            q_bias, k_bias, v_bias = self.qkv_lin.bias.chunk(3, dim=0)
+            q = nn.functional.linear(query, q_weight, q_bias)  # (bs, q_length, dim)
+            k = nn.functional.linear(key, k_weight, k_bias)  # (bs, k_length, dim)
+            v = nn.functional.linear(value, v_weight, v_bias)  # (bs, k_length, dim)
+        q = shape(q)  # (bs, n_heads, q_length, dim_per_head)
+        k = shape(k)  # (bs, n_heads, k_length, dim_per_head)
+        v = shape(v)  # (bs, n_heads, k_length, dim_per_head)
+
+        if not output_attentions and head_mask is None and hasattr(nn.functional, "scaled_dot_product_attention"):
+            # Fused kernel: the attention weights are never materialized, so this path can neither return them nor
+            # mask individual heads.
+            context = nn.functional.scaled_dot_product_attention(
+                q, k, v, attn_mask=mask.to(q.dtype), dropout_p=self.attn_dropout_p if self.training else 0.0
+            )  # (bs, n_heads, q_length, dim_per_head)
+        else:
+            q = q / math.sqrt(dim_per_head)  # (bs, n_heads, q_length, dim_per_head)
+            scores = torch.matmul(q, k.transpose(2, 3))  # (bs, n_heads, q_length, k_length)
+            scores = scores + mask  # (bs, n_heads, q_length, k_length)
 
-        weights = nn.Softmax(dim=-1)(scores)  # (bs, n_heads, q_length, k_length)
-        weights = self.dropout(weights)  # (bs, n_heads, q_length, k_length)
+            # softmax accumulates in fp32 under mixed precision
+            weights = nn.functional.softmax(scores, dim=-1, dtype=torch.float32)  # (bs, n_heads, q_length, k_length)
+            weights = weights.to(scores.dtype)
+            weights = nn.functional.dropout(weights, self.attn_dropout_p, self.training)  # (bs, n_heads, q_len, k_len)
 
-        # Mask heads if we want to
-        if head_mask is not None:
-            weights = weights * head_mask
+            # Mask heads if we want to
+            if head_mask is not None:
+                weights = weights * head_mask
 
-        context = torch.matmul(weights, v)  # (bs, n_heads, q_length, dim_per_head)
+            context = torch.matmul(weights, v)  # (bs, n_heads, q_length, dim_per_head)
         context = unshape(context)  # (bs, q_length, dim)
         context = self.out_lin(context)  # (bs, q_length, dim)
 
@@ -226,22 +389,28 @@ class MultiHeadSelfAttention(nn.Module):
 class FFN(nn.Module):
     def __init__(self, config):
         super().__init__()
-        self.dropout = nn.Dropout(p=config.dropout)
+        self.dropout_p = config.dropout
         self.chunk_size_feed_forward = config.chunk_size_feed_forward
         self.seq_len_dim = 1
         self.lin1 = nn.Linear(in_features=config.dim, out_features=config.hidden_dim)
         self.lin2 = nn.Linear(in_features=config.hidden_dim, out_features=config.dim)
         assert config.activation in ["relu", "gelu"], f"activation ({config.activation}) must be in ['relu', 'gelu']"
         self.activation = gelu if config.activation == "gelu" else nn.ReLU()
+        self.fuse_bias_gelu = config.activation == "gelu"
 
     def forward(self, input):
+        if self.chunk_size_feed_forward == 0:
+            return self.ff_chunk(input)
         return apply_chunking_to_forward(self.ff_chunk, self.chunk_size_feed_forward, self.seq_len_dim, input)
 
     def ff_chunk(self, input):
-        x = self.lin1(input)
-        x = self.activation(x)
+        if self.fuse_bias_gelu:
+            x = bias_gelu(nn.functional.linear(input, self.lin1.weight), self.lin1.bias)
+        else:
+            x = self.lin1(input)
+            x = self.activation(x)
         x = self.lin2(x)
-        x = self.dropout(x)
+        x = nn.functional.dropout(x, self.dropout_p, self.training)
         return x
 
 
@@ -252,16 +421,16 @@ class TransformerBlock(nn.Module):
         assert config.dim % config.n_heads == 0
 
         self.attention = MultiHeadSelfAttention(config)
-        self.sa_layer_norm = nn.LayerNorm(normalized_shape=config.dim, eps=1e-12)
+        self.sa_layer_norm = _make_layer_norm(config.dim, eps=1e-12)
 
         self.ffn = FFN(config)
-        self.output_layer_norm = nn.LayerNorm(normalized_shape=config.dim, eps=1e-12)
+        self.output_layer_norm = _make_layer_norm(config.dim, eps=1e-12)
 
     def forward(self, x, attn_mask=None, head_mask=None, output_attentions=False):
         """
         Parameters:
             x: torch.tensor(bs, seq_length, dim)
-            attn_mask: torch.tensor(bs, seq_length)
+            attn_mask: torch.tensor(bs, 1, 1, seq_length) Additive attention mask.
 
         Returns:
             sa_weights: torch.tensor(bs, n_heads, seq_length, seq_length) The attention weights ffn_output:
@@ -281,11 +450,11 @@ class TransformerBlock(nn.Module):
         else:  # To handle these `output_attentions` or `output_hidden_states` cases returning tuples
             assert type(sa_output) == tuple
             sa_output = sa_output[0]
-        sa_output = self.sa_layer_norm(sa_output + x)  # (bs, seq_length, dim)
+        sa_output = fused_add_layer_norm(sa_output, x, self.sa_layer_norm)  # (bs, seq_length, dim)
 
         # Feed Forward Network
         ffn_output = self.ffn(sa_output)  # (bs, seq_length, dim)
-        ffn_output = self.output_layer_norm(ffn_output + sa_output)  # (bs, seq_length, dim)
+        ffn_output = fused_add_layer_norm(ffn_output, sa_output, self.output_layer_norm)  # (bs, seq_length, dim)
 
         output = (ffn_output,)
         if output_attentions:
@@ -298,9 +467,31 @@ class Transformer(nn.Module):
         super().__init__()
         self.n_layers = config.n_layers
         self.layer = nn.ModuleList([TransformerBlock(config) for _ in range(config.n_layers)])
+        if getattr(config, "use_torch_compile", False):
+            # Compile each block in place (parameter names are unchanged); the interchange logic in `forward` is
+            # data-dependent Python and stays eager.
+            for layer_module in self.layer:
+                layer_module.compile(mode="reduce-overhead")
         self.config = config
         self.head_dimension = config.hidden_size // config.num_attention_heads
-        
+        # hidden feature indices of an interchange, keyed by its (head, start, stop) slices and device.
+        self._interchange_index_cache = {}
+
+    def _interchange_feature_index(self, layer_variables, device):
+        """
+        Returns the hidden-state feature indices covered by the interchanged variables of one layer, in the order the
+        variables are listed, as a cached torch.tensor(n_features).
+        """
+        key = (tuple((head_index, LOC.start, LOC.stop) for _, head_index, LOC in layer_variables), device)
+        if key not in self._interchange_index_cache:
+            self._interchange_index_cache[key] = torch.cat(
+                [
+                    torch.arange(LOC.start, LOC.stop, device=device) + head_index * self.head_dimension
+                    for _, head_index, LOC in layer_variables
+                ]
+            )
+        return self._interchange_index_cache[key]
+
     def forward(
         self, x, attn_mask=None, head_mask=None, output_attentions=False, output_hidden_states=False, return_dict=None,
         # for interchange.
@@ -312,7 +503,7 @@ class Transformer(nn.Module):
         """
         Parameters:
             x: torch.tensor(bs, seq_length, dim) Input sequence embedded.
-            attn_mask: torch.tensor(bs, seq_length) Attention mask on the sequence.
+            attn_mask: torch.tensor(bs, 1, 1, seq_length) Additive attention mask on the sequence.
 
         Returns:
             hidden_state: torch.tensor(bs, seq_length, dim) Sequence of hidden states in the last (top)
@@ -323,13 +514,19 @@ class Transformer(nn.Module):
                 Tuple of length n_layers with the attention weights from each layer
                 Optional: only if output_attentions=True
         """
-        all_hidden_states = () if output_hidden_states else None
-        all_attentions = () if output_attentions else None
+        all_hidden_states = [] if output_hidden_states else None
+        all_attentions = [] if output_attentions else None
+
+        # Split the head mask into per-layer tensors once rather than indexing a tensor in every iteration.
+        if head_mask is None:
+            head_mask = [None] * self.n_layers
+        elif isinstance(head_mask, torch.Tensor):
+            head_mask = head_mask.unbind(0)
 
         hidden_state = x
         for i, layer_module in enumerate(self.layer):
             if output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_state,)
+                all_hidden_states.append(hidden_state)
 
             layer_outputs = layer_module(
                 x=hidden_state, attn_mask=attn_mask, head_mask=head_mask[i], output_attentions=output_attentions
@@ -340,23 +537,28 @@ class Transformer(nn.Module):
             # we need to interchange!
             if variable_names != None and variable_names != "embeddings" and i in variable_names:
                 assert interchanged_variables != None
-                for interchanged_variable in variable_names[i]:
-                    interchanged_activations = interchanged_variables[interchanged_variable[0]]
-                    start_index = interchanged_variable[1]*self.head_dimension + interchanged_variable[2].start
-                    stop_index = start_index + interchanged_variable[2].stop
-                    replacing_activations = interchanged_activations[dual_interchange_mask]
-                    hidden_state[...,start_index:stop_index][interchange_mask] = replacing_activations
+                # swap all the variables of this layer with a single scatter.
+                feature_index = self._interchange_feature_index(variable_names[i], hidden_state.device)
+                replacing_activations = torch.cat(
+                    [interchanged_variables[interchanged_variable[0]] for interchanged_variable in variable_names[i]],
+                    dim=-1,
+                )[dual_interchange_mask]  # (n_interchanged_tokens, n_features)
+                batch_index, position_index = interchange_mask.nonzero(as_tuple=True)
+                hidden_state[batch_index[:, None], position_index[:, None], feature_index] = replacing_activations
 
             if output_attentions:
                 assert len(layer_outputs) == 2
                 attentions = layer_outputs[0]
-                all_attentions = all_attentions + (attentions,)
+                all_attentions.append(attentions)
             else:
                 assert len(layer_outputs) == 1
 
         # Add last layer
         if output_hidden_states:
-            all_hidden_states = all_hidden_states + (hidden_state,)
+            all_hidden_states.append(hidden_state)
+            all_hidden_states = tuple(all_hidden_states)
+        if output_attentions:
+            all_attentions = tuple(all_attentions)
 
         if not return_dict:
             return tuple(v for v in [hidden_state, all_hidden_states, all_attentions] if v is not None)
@@ -388,7 +590,7 @@ class DistilBertPreTrainedModel(PreTrainedModel):
             module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
             if module.padding_idx is not None:
                 module.weight.data[module.padding_idx].zero_()
-        elif isinstance(module, nn.LayerNorm):
+        elif isinstance(module, nn.LayerNorm) or (FusedLayerNorm is not None and isinstance(module, FusedLayerNorm)):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
@@ -495,7 +697,9 @@ class DistilBertModel(DistilBertPreTrainedModel):
 
         if self.config.sinusoidal_pos_embds:
             create_sinusoidal_embeddings(
-                n_pos=self.config.max_position_embeddings, dim=self.config.dim, out=self.position_embeddings.weight
+                n_pos=self.config.max_position_embeddings,
+                dim=self.config.dim,
+                out=self.embeddings.position_embeddings.weight,
             )
         else:
             with torch.no_grad():
@@ -574,9 +778,12 @@ class DistilBertModel(DistilBertPreTrainedModel):
 
         if inputs_embeds is None:
             inputs_embeds = self.embeddings(input_ids)  # (bs, seq_length, dim)
+
+        # Build the additive (bs, 1, 1, seq_length) mask once here instead of in every attention layer.
+        extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(attention_mask, input_shape, device)
         return self.transformer(
             x=inputs_embeds,
-            attn_mask=attention_mask,
+            attn_mask=extended_attention_mask,
             head_mask=head_mask,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
@@ -601,15 +808,27 @@ class DistilBertForMaskedLM(DistilBertPreTrainedModel):
         self.vocab_layer_norm = nn.LayerNorm(config.dim, eps=1e-12)
         self.vocab_projector = nn.Linear(config.dim, config.vocab_size)
 
+        # `init_weights` calls `tie_weights`, which makes `vocab_projector.weight` (see `get_output_embeddings`) share
+        # the word embedding matrix as long as `config.tie_word_embeddings` is set (the default).
         self.init_weights()
 
+        # bf16 autocast for the encoder and the LM head, whose logits are returned in bf16; losses reduce in fp32.
+        self.use_autocast = getattr(config, "use_autocast", False)
+        if self.use_autocast:
+            torch.backends.cuda.matmul.allow_tf32 = True
+
         self.mlm_loss_fct = nn.CrossEntropyLoss()
         
         # we actually calculate loss here so that it is parallel.
-        self.ce_loss_fct = nn.KLDivLoss(reduction="batchmean")
         self.lm_loss_fct = nn.CrossEntropyLoss(ignore_index=-100)
-        self.mse_loss_fct = nn.MSELoss(reduction="sum")
-        self.cosine_loss_fct = nn.CosineEmbeddingLoss(reduction="mean")
+
+        # one graph for the regular and the causal distillation losses; dynamic since n_kept changes every batch.
+        self._distill_losses = distill_losses
+        if getattr(config, "use_torch_compile", False):
+            self._distill_losses = torch.compile(distill_losses, mode="reduce-overhead", dynamic=True)
+
+        # side CUDA streams for the causal cosine loss, one per device, created on first use.
+        self._aux_streams = {}
 
 
     def get_position_embeddings(self) -> nn.Embedding:
@@ -639,6 +858,19 @@ class DistilBertForMaskedLM(DistilBertPreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.vocab_projector = new_embeddings
 
+    def _autocast(self, device):
+        # `torch.autocast` only exists from torch 1.10, so it is not entered at all unless autocast is requested.
+        if not self.use_autocast:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+    def _get_aux_stream(self, device):
+        # DataParallel replicas get a shallow copy of `__dict__`: the dict itself is shared, so a stream created by a
+        # replica is cached for the next step, keyed by the replica's device.
+        if device not in self._aux_streams:
+            self._aux_streams[device] = torch.cuda.Stream(device=device)
+        return self._aux_streams[device]
+
     @add_start_docstrings_to_model_forward(DISTILBERT_INPUTS_DOCSTRING.format("batch_size, num_choices"))
     @add_code_sample_docstrings(
         tokenizer_class=_TOKENIZER_FOR_DOC,
@@ -671,41 +903,63 @@ class DistilBertForMaskedLM(DistilBertPreTrainedModel):
         temperature=None,
         restrict_ce_to_mask=None,
         lm_labels=None,
+        kept_token_idx=None,
+        alpha_ce=1.0,
         alpha_mlm=0.0,
         alpha_clm=0.0,
         alpha_mse=0.0,
         alpha_cos=0.0,
+        skip_lm_head=False,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
             Labels for computing the masked language modeling loss. Indices should be in ``[-100, 0, ...,
             config.vocab_size]`` (see ``input_ids`` docstring) Tokens with indices set to ``-100`` are ignored
             (masked), the loss is only computed for the tokens with labels in ``[0, ..., config.vocab_size]``.
+        skip_lm_head (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether or not to skip the language modeling head and return no logits, e.g. when the forward is only
+            run to collect hidden states for an interchange.
+        kept_token_idx (:obj:`torch.LongTensor` of shape :obj:`(n_kept,)`, `optional`):
+            Flat indices of the tokens with a language modeling label, used by the distillation losses when
+            ``restrict_ce_to_mask`` is set. Computed from ``lm_labels`` if not provided.
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        if output_hidden_states is None and t_logits is not None:
+            # the student hidden states are only read by the cosine losses, so skip keeping them around otherwise.
+            output_hidden_states = alpha_cos > 0.0 or causal_t_logits is not None
 
-        dlbrt_output = self.distilbert(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-            interchanged_variables=interchanged_variables,
-            variable_names=variable_names,
-            interchange_mask=interchange_mask,
-            dual_interchange_mask=dual_interchange_mask,
-        )
-        hidden_states = dlbrt_output[0]  # (bs, seq_length, dim)
-        prediction_logits = self.vocab_transform(hidden_states)  # (bs, seq_length, dim)
-        prediction_logits = gelu(prediction_logits)  # (bs, seq_length, dim)
-        prediction_logits = self.vocab_layer_norm(prediction_logits)  # (bs, seq_length, dim)
-        prediction_logits = self.vocab_projector(prediction_logits)  # (bs, seq_length, vocab_size)
+        device = input_ids.device if input_ids is not None else inputs_embeds.device
+        with self._autocast(device):
+            dlbrt_output = self.distilbert(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+                interchanged_variables=interchanged_variables,
+                variable_names=variable_names,
+                interchange_mask=interchange_mask,
+                dual_interchange_mask=dual_interchange_mask,
+            )
+            prediction_logits = None
+            if not skip_lm_head:
+                hidden_states = dlbrt_output[0]  # (bs, seq_length, dim)
+                prediction_logits = self.vocab_transform(hidden_states)  # (bs, seq_length, dim)
+                prediction_logits = gelu_layer_norm(
+                    prediction_logits,
+                    self.vocab_layer_norm.weight,
+                    self.vocab_layer_norm.bias,
+                    self.vocab_layer_norm.eps,
+                )  # (bs, seq_length, dim)
+                prediction_logits = self.vocab_projector(prediction_logits)  # (bs, seq_length, vocab_size)
+        # under autocast the logits stay bf16: the distillation losses read them at half the bandwidth, and the
+        # language modeling losses upcast only their labelled rows.
 
         mlm_loss = None
         if labels is not None:
-            mlm_loss = self.mlm_loss_fct(prediction_logits.view(-1, prediction_logits.size(-1)), labels.view(-1))
+            mlm_loss = labelled_lm_loss(self.mlm_loss_fct, prediction_logits, labels)
 
         if not return_dict:
             output = (prediction_logits,) + dlbrt_output[1:]
@@ -718,111 +972,99 @@ class DistilBertForMaskedLM(DistilBertPreTrainedModel):
             attentions=dlbrt_output.attentions,
         )
 
-        if causal_t_logits is None:
-            # if it is None, it is simply a forward for getting hidden states!
-            if t_logits is not None:
+        if t_logits is not None:
+            # flat indices of the kept tokens, computed once and shared by every loss below.
+            token_keep_idx = attention_mask.reshape(-1).nonzero(as_tuple=True)[0]  # (n_tokens,)
+            if restrict_ce_to_mask and kept_token_idx is not None:
+                keep_idx = kept_token_idx  # (n_kept,)
+            elif restrict_ce_to_mask:
+                keep_idx = (lm_labels > -1).reshape(-1).nonzero(as_tuple=True)[0]  # (n_kept,)
+            else:
+                keep_idx = token_keep_idx  # (n_kept,)
+
+        # the distillation losses are bandwidth-bound; autocast keeps the reductions themselves in fp32.
+        with self._autocast(device):
+            if causal_t_logits is None:
+                # if it is None, it is simply a forward for getting hidden states!
+                if t_logits is not None:
+                    assert t_hidden_states is not None
+                    # regular loss
+                    s_logits, s_hidden_states = student_outputs["logits"], student_outputs.hidden_states
+                    assert s_logits.size() == t_logits.size()
+                    if alpha_cos > 0.0:
+                        assert s_hidden_states[-1].size() == t_hidden_states[-1].size()
+                    losses = self._distill_losses(
+                        s_logits,
+                        t_logits,
+                        s_hidden_states[-1] if alpha_cos > 0.0 else None,
+                        t_hidden_states[-1] if alpha_cos > 0.0 else None,
+                        keep_idx,
+                        token_keep_idx,
+                        temperature,
+                        with_ce=alpha_ce > 0.0,
+                        with_mse=alpha_mse > 0.0,
+                    )
+                    if alpha_ce > 0.0:
+                        student_outputs["loss_ce"] = losses["ce"]
+
+                    # other distillation loss.
+                    if alpha_clm > 0.0:
+                        # shift the labels left rather than the logits: position i is scored against token i + 1 and
+                        # the last position is ignored, so the (bs, seq_length, voc_size) logits are never copied.
+                        shift_labels = nn.functional.pad(lm_labels[..., 1:], (0, 1), value=-100)  # (bs, seq_length)
+                    if alpha_mlm > 0.0 and alpha_clm > 0.0:
+                        # one log_softmax shared by the two label sets.
+                        loss_mlm, loss_clm = labelled_lm_losses(s_logits, lm_labels, shift_labels)
+                        student_outputs["loss_mlm"] = loss_mlm
+                        student_outputs["loss_clm"] = loss_clm
+                    elif alpha_mlm > 0.0:
+                        loss_mlm = labelled_lm_loss(self.lm_loss_fct, s_logits, lm_labels)
+                        student_outputs["loss_mlm"] = loss_mlm
+                    elif alpha_clm > 0.0:
+                        loss_clm = labelled_lm_loss(self.lm_loss_fct, s_logits, shift_labels)
+                        student_outputs["loss_clm"] = loss_clm
+                    if alpha_mse > 0.0:
+                        student_outputs["loss_mse"] = losses["mse"]
+                    if alpha_cos > 0.0:
+                        student_outputs["loss_cos"] = losses["cos"]
+            # causal distillation loss.
+            else:
+                # if it is None, it is simply a forward for getting hidden states!
+                assert t_logits is not None
                 assert t_hidden_states is not None
-                # regular loss
-                s_logits, s_hidden_states = student_outputs["logits"], student_outputs["hidden_states"]
-                assert s_logits.size() == t_logits.size()
-                # https://github.com/peterliht/knowledge-distillation-pytorch/blob/master/model/net.py#L100
-                # https://github.com/peterliht/knowledge-distillation-pytorch/issues/2
-                if restrict_ce_to_mask:
-                    mask = (lm_labels > -1).unsqueeze(-1).expand_as(s_logits)  # (bs, seq_length, voc_size)
+                assert s_logits is not None
+                assert causal_t_hidden_states is not None
+
+                causal_s_logits, causal_s_hidden_states = \
+                    student_outputs["logits"], student_outputs["hidden_states"]
+                assert causal_s_logits.size() == causal_t_logits.size()
+                assert causal_s_hidden_states[-1].size() == causal_t_hidden_states[-1].size()
+                # same losses as the regular forward, on the interchanged outputs.
+                if device.type == "cuda":
+                    # the cosine loss does not depend on the CE one: overlap it on a side stream.
+                    aux_stream = self._get_aux_stream(device)
+                    aux_stream.wait_stream(torch.cuda.current_stream(device))
+                    with torch.cuda.stream(aux_stream):
+                        causal_loss_cos = selected_cosine_loss(
+                            causal_s_hidden_states[-1], causal_t_hidden_states[-1], token_keep_idx
+                        )
+                    causal_losses = self._distill_losses(
+                        causal_s_logits, causal_t_logits, None, None, keep_idx, token_keep_idx, temperature
+                    )
+                    torch.cuda.current_stream(device).wait_stream(aux_stream)
+                    causal_losses["cos"] = causal_loss_cos
                 else:
-                    mask = attention_mask.unsqueeze(-1).expand_as(s_logits)  # (bs, seq_length, voc_size)
-                s_logits_slct = torch.masked_select(s_logits, mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-                s_logits_slct = s_logits_slct.view(-1, s_logits.size(-1))  # (bs * seq_length, voc_size) modulo the 1s in mask
-                t_logits_slct = torch.masked_select(t_logits, mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-                t_logits_slct = t_logits_slct.view(-1, s_logits.size(-1))  # (bs * seq_length, voc_size) modulo the 1s in mask
-                assert t_logits_slct.size() == s_logits_slct.size()
-
-                loss_ce = (
-                    self.ce_loss_fct(
-                        nn.functional.log_softmax(s_logits_slct / temperature, dim=-1),
-                        nn.functional.softmax(t_logits_slct / temperature, dim=-1),
+                    causal_losses = self._distill_losses(
+                        causal_s_logits,
+                        causal_t_logits,
+                        causal_s_hidden_states[-1],
+                        causal_t_hidden_states[-1],
+                        keep_idx,
+                        token_keep_idx,
+                        temperature,
                     )
-                    * (temperature) ** 2
-                )
-                student_outputs["loss_ce"] = loss_ce
-
-                # other distillation loss.
-                if alpha_mlm > 0.0:
-                    loss_mlm = self.lm_loss_fct(s_logits.view(-1, s_logits.size(-1)), lm_labels.view(-1))
-                    student_outputs["loss_mlm"] = loss_mlm
-                if alpha_clm > 0.0:
-                    shift_logits = s_logits[..., :-1, :].contiguous()
-                    shift_labels = lm_labels[..., 1:].contiguous()
-                    loss_clm = self.lm_loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
-                    student_outputs["loss_mlm"] = loss_clm
-                if alpha_mse > 0.0:
-                    loss_mse = self.mse_loss_fct(s_logits_slct, t_logits_slct) / s_logits_slct.size(
-                        0
-                    )  # Reproducing batchmean reduction
-                    student_outputs["loss_mse"] = loss_mse
-                if alpha_cos > 0.0:
-                    s_hidden_states = s_hidden_states[-1]  # (bs, seq_length, dim)
-                    t_hidden_states = t_hidden_states[-1]  # (bs, seq_length, dim)
-                    mask = attention_mask.unsqueeze(-1).expand_as(s_hidden_states)  # (bs, seq_length, dim)
-                    assert s_hidden_states.size() == t_hidden_states.size()
-                    dim = s_hidden_states.size(-1)
-
-                    s_hidden_states_slct = torch.masked_select(s_hidden_states, mask)  # (bs * seq_length * dim)
-                    s_hidden_states_slct = s_hidden_states_slct.view(-1, dim)  # (bs * seq_length, dim)
-                    t_hidden_states_slct = torch.masked_select(t_hidden_states, mask)  # (bs * seq_length * dim)
-                    t_hidden_states_slct = t_hidden_states_slct.view(-1, dim)  # (bs * seq_length, dim)
-
-                    target = s_hidden_states_slct.new(s_hidden_states_slct.size(0)).fill_(1)  # (bs * seq_length,)
-                    loss_cos = self.cosine_loss_fct(s_hidden_states_slct, t_hidden_states_slct, target)
-                    student_outputs["loss_cos"] = loss_cos
-        # causal distillation loss.
-        else:
-            # if it is None, it is simply a forward for getting hidden states!
-            assert t_logits is not None
-            assert t_hidden_states is not None
-            assert s_logits is not None
-            assert s_hidden_states is not None
-            assert causal_t_hidden_states is not None
-
-            causal_s_logits, causal_s_hidden_states = \
-                student_outputs["logits"], student_outputs["hidden_states"]
-            assert causal_s_logits.size() == causal_t_logits.size()
-            # https://github.com/peterliht/knowledge-distillation-pytorch/blob/master/model/net.py#L100
-            # https://github.com/peterliht/knowledge-distillation-pytorch/issues/2
-            if restrict_ce_to_mask:
-                causal_mask = (lm_labels > -1).unsqueeze(-1).expand_as(causal_s_logits)  # (bs, seq_length, voc_size)
-            else:
-                causal_mask = attention_mask.unsqueeze(-1).expand_as(causal_s_logits)  # (bs, seq_length, voc_size)
-            causal_s_logits_slct = torch.masked_select(causal_s_logits, causal_mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-            causal_s_logits_slct = causal_s_logits_slct.view(-1, causal_s_logits.size(-1))  # (bs * seq_length, voc_size) modulo the 1s in mask
-            causal_t_logits_slct = torch.masked_select(causal_t_logits, causal_mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-            causal_t_logits_slct = causal_t_logits_slct.view(-1, causal_s_logits.size(-1))  # (bs * seq_length, voc_size) modulo the 1s in mask
-            assert causal_t_logits_slct.size() == causal_s_logits_slct.size()
-            
-            causal_loss_ce = (
-                self.ce_loss_fct(
-                    nn.functional.log_softmax(causal_s_logits_slct / temperature, dim=-1),
-                    nn.functional.softmax(causal_t_logits_slct / temperature, dim=-1),
-                )
-                * (temperature) ** 2
-            )
-            student_outputs["causal_loss_ce"] = causal_loss_ce
-            
-            # now, let us get causal_loss_cos as well.
-            s_hidden_states = causal_s_hidden_states[-1]  # (bs, seq_length, dim)
-            t_hidden_states = causal_t_hidden_states[-1]  # (bs, seq_length, dim)
-            mask = attention_mask.unsqueeze(-1).expand_as(s_hidden_states)  # (bs, seq_length, dim)
-            assert s_hidden_states.size() == t_hidden_states.size()
-            dim = s_hidden_states.size(-1)
-
-            s_hidden_states_slct = torch.masked_select(s_hidden_states, mask)  # (bs * seq_length * dim)
-            s_hidden_states_slct = s_hidden_states_slct.view(-1, dim)  # (bs * seq_length, dim)
-            t_hidden_states_slct = torch.masked_select(t_hidden_states, mask)  # (bs * seq_length * dim)
-            t_hidden_states_slct = t_hidden_states_slct.view(-1, dim)  # (bs * seq_length, dim)
-
-            target = s_hidden_states_slct.new(s_hidden_states_slct.size(0)).fill_(1)  # (bs * seq_length,)
-            causal_loss_cos = self.cosine_loss_fct(s_hidden_states_slct, t_hidden_states_slct, target)
-            student_outputs["causal_loss_cos"] = causal_loss_cos
+                student_outputs["causal_loss_ce"] = causal_losses["ce"]
+                student_outputs["causal_loss_cos"] = causal_losses["cos"]
 
         return student_outputs
 